@@ -5,12 +5,29 @@
 # Expect for it to perform the worst, as it does not have any means of ensuring
 # that packets do not reach "black hole" nodes.
 
-import networkx as nx
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+import numpy as np
+import rustworkx as rx
 import random
+import sys
 
 # A global object for storing all network adjacencies and paths.
 # We assume that every device knows the full network topology, for simplicity.
-NETWORK = nx.Graph()
+NETWORK = rx.PyGraph()
+
+# The number of times every device sends a ping in a run of the simulation.
+ITERATIONS = 100
+
+# How a device chooses between the paths to a destination that are still clear
+# of the message's history: "random" picks any of them with equal chance, while
+# "first_clear" always takes the shortest one. Each run sets it, "random" unless
+# another of FORWARD_MODES is given on the command line.
+FORWARD_MODES = ("random", "first_clear")
+FORWARD_MODE = "random"
+
+# The one source of randomness in the simulation, reseeded for every run.
+RNG = random.Random()
 
 # Statistics for reliability
 PINGS_SENT = 0
@@ -18,116 +35,161 @@ PINGS_RCVD = 0
 PONGS_RCVD = 0
 DROP_COUNT = 0
 
+# Pack a list of paths into two arrays: the next hop of each path, and the
+# bitmask of the indices each path visits after leaving its first node, so that
+# every path can be checked against a message's history at once. Forwarding
+# never needs more of a path than that.
+def path_table(paths):
+    width = max(len(p) for p in paths)
+    table = [p + [-1] * (width - len(p)) for p in paths]
+    table = np.array(table, dtype=np.int8)
+    
+    hops = table[:, 1:]
+    bits = np.left_shift(np.uint32(1), np.maximum(hops, 0).astype(np.uint32))
+    bits = np.where(hops >= 0, bits, 0)
+    return hops[:, 0].copy(), np.bitwise_or.reduce(bits, axis=1)
+
+# Randomly select a path from one (src, dst) pair's path table that does not
+# pass through any index in hist_mask, and return its next hop, or -1 if there
+# are none. r is a uniform random number in [0, 1) that decides which of the
+# clear paths is chosen, so every one of them is equally likely. It is the only
+# random number used, so that a seed gives the same results with or without the
+# compiled version below.
+# The table is given as the path_masks and path_hops arrays from path_table.
+# first_clear_hop instead returns the next hop of the first clear path, which is
+# the shortest, as the tables are sorted by length.
+# This is the inner loop of the baseline, and routing.pyx has compiled versions
+# of both, which are used instead once it has been built.
+try:
+    from routing import next_hop, first_clear_hop
+except ImportError:
+    def next_hop(hist_mask, path_masks, path_hops, r):
+        options = np.flatnonzero((path_masks & hist_mask) == 0)
+        if len(options) == 0:
+            return -1
+        return int(path_hops[options[int(r * len(options))]])
+    
+    def first_clear_hop(hist_mask, path_masks, path_hops):
+        clear = (path_masks & hist_mask) == 0
+        choice = clear.argmax()
+        if not clear[choice]:
+            return -1
+        return int(path_hops[choice])
+
 # A simple message with a sender, intended receiver, data, and a history of the
 # indices of recipients who have forwarded on this message. The src and dst
 # fields are the indices of the original sender and intended recipient.
+# The history is a bitmask, where bit i is set if device i has forwarded it.
 class Message:
     def __init__(self, src, dst, content):
         self.src = src
         self.dst = dst
         self.content = content
-        self.history = []
+        self.history_mask = 0
     
     # Mark a message as having been sent by a device.
     def postmark(self, index):
-        self.history.append(index)
-    
-    # Report if any of the elements in a path are in the message's history.
-    def has_cycles_in(self, path):
-        for index in path:
-            if index in self.history:
-                return True
-        return False
+        self.history_mask |= 1 << index
 
 # Every node in the network has an index and an associated device.
 # The index is how the device is found in the global NETWORK object.
-# The device is an actor that creates, receives, and acts upon messages.
+# The device is an actor that creates, receives, and acts upon messages, and
+# the state of every device is kept in the arrays below, indexed the same way.
 # Every device has a set level of "greed", indicating how likely it is to behave
 # selfishly. A value of 0 means never, 1 means always, in between is random.
 # Count is the number of packets the device has been given to forward.
-class Device:    
-    def __init__(self, index, greed):
-        self.index = index
-        self.greed = greed
-        self.count = 0
+GREED = np.zeros(26)
+COUNT = np.zeros(26, dtype=int)
+
+# Chooses the best receiver for the device at index to forward a message to.
+# In other implementations, this is where we would place our "trust" system.
+# In all implementations, we are assuming we have already made the decision
+# to forward the packet. Nodes that are selfish won't call this method.
+# Returns the next hop in the message's path, or None if dropped.
+def forward_msg(index, msg):
+    # Always forward to the intended recipient if possible.
+    if ADJ_MASK[index] >> msg.dst & 1:
+        msg.postmark(index)
+        return msg.dst
     
-    # Forwards a message to the best receiver possible.
-    # In other implementations, this is where we would place our "trust" system.
-    # In all implementations, we are assuming we have already made the decision
-    # to forward the packet. Nodes that are selfish won't call this method.
-    # Returns the next hop in the message's path, or None if dropped.
-    def forward_msg(self, msg):
-        # Always forward to the intended recipient if possible.
-        if NETWORK.has_edge(self.index, msg.dst):
-            msg.postmark(self.index)
-            NETWORK.nodes[msg.dst]["device"].receive_msg(msg)
-            return msg.dst
-        
-        # Find a path that does not return to a previously visited node.
-        spl = nx.shortest_path_length(NETWORK, self.index, msg.dst)
-        paths = nx.all_simple_paths(NETWORK, self.index, msg.dst, cutoff=3+spl)
-        options = [p for p in list(paths) if not msg.has_cycles_in(p)]
-        
-        # If none exist, drop the packet. This should not happen.
-        if len(options) == 0:
-            return None
-        
-        # Otherwise, randomly select a path.
-        # If we were less trustworthy, we might be more selective here.
-        choice = random.choice(options)
-        next_hop = choice[1]
-        
-        # Send the message on its merry way.
-        msg.postmark(self.index)
-        NETWORK.nodes[next_hop]["device"].receive_msg(msg)
-        return next_hop
+    # Randomly select a path that does not return to a previously visited node.
+    # If we were less trustworthy, we might be more selective here.
+    masks = PATH_MASKS[(index, msg.dst)]
+    hops = PATH_HOPS[(index, msg.dst)]
+    if FORWARD_MODE == "first_clear":
+        hop = first_clear_hop(msg.history_mask, masks, hops)
+    else:
+        hop = next_hop(msg.history_mask, masks, hops, RNG.random())
     
-    # Called by other devices sending this device a message.
-    # Here we decide whether to forward or drop a packet, or to do something
-    # with it, as we are the intended recipient.
-    # NOTE: update trust scores when ping or pong received.
-    def receive_msg(self, msg):
-        global PINGS_SENT
-        global PINGS_RCVD
-        global PONGS_RCVD
-        global DROP_COUNT
-        
-        if self.index == msg.dst:
-            if msg.content == "ping":
-                PINGS_RCVD += 1
-                response = Message(self.index, msg.src, "pong")
-                self.forward_msg(response)
-            elif msg.content == "pong":
-                PONGS_RCVD += 1
-        elif random.random() >= self.greed:
-            self.count += 1
-            self.forward_msg(msg)
-        else:
-            self.count += 1
-            DROP_COUNT += 1
+    # If none exist, drop the packet. This should not happen.
+    if hop < 0:
+        return None
+    
+    # Send the message on its merry way.
+    msg.postmark(index)
+    return hop
+
+# Called when other devices send the device at index a message.
+# Here we decide whether to forward or drop a packet, or to do something
+# with it, as we are the intended recipient.
+# Returns the message to forward on next, either this one or our reply to
+# it, or None if there is nothing more to send.
+# NOTE: update trust scores when ping or pong received.
+def receive_msg(index, msg):
+    global PINGS_SENT
+    global PINGS_RCVD
+    global PONGS_RCVD
+    global DROP_COUNT
+    
+    if index == msg.dst:
+        if msg.content == "ping":
+            PINGS_RCVD += 1
+            return Message(index, msg.src, "pong")
+        elif msg.content == "pong":
+            PONGS_RCVD += 1
+    elif RNG.random() >= GREED[index]:
+        COUNT[index] += 1
+        return msg
+    else:
+        COUNT[index] += 1
+        DROP_COUNT += 1
+    return None
+
+# Have the device at index create a message to a random destination, and send
+# it off.
+# NOTE: decrement trust scores if no pong received after forward_msg.
+def produce_msg(index):
+    global PINGS_SENT
+    
+    # Select a random destination other than ourselves, by picking from
+    # the 25 other indices and skipping over our own.
+    dst = RNG.randrange(25)
+    if dst >= index:
+        dst += 1
+    src = index
     
-    # Create a new message to a random destination, and send it off.
-    # NOTE: decrement trust scores if no pong received after forward_msg.
-    def produce_msg(self):
-        global PINGS_SENT
-        
-        # Select a random destination other than ourselves.
-        destinations = [i for i in NETWORK.nodes if i != self.index]
-        dst = random.choice(destinations)
-        src = self.index
-        
-        # Create a message and send it off into the ethers.
-        PINGS_SENT += 1
-        msg = Message(src, dst, "ping")
-        self.forward_msg(msg)
+    # Create a message and send it off into the ethers.
+    PINGS_SENT += 1
+    msg = Message(src, dst, "ping")
+    deliver(forward_msg(index, msg), msg)
+
+# Carry a message the rest of the way once it has been forwarded to hop.
+# Each device along the way receives it, then forwards it or its reply on in
+# turn, until there is nothing more to send or nowhere to send it.
+def deliver(hop, msg):
+    while hop is not None:
+        msg = receive_msg(hop, msg)
+        if msg is None:
+            return
+        hop = forward_msg(hop, msg)
 
 # Setup network connections
 black_holes = [1,2,8,11,22]
 for i in range(0, 26):
-    greed = float(i in black_holes)
-    NETWORK.add_node(i, device=Device(i, greed))
+    GREED[i] = float(i in black_holes)
+    NETWORK.add_node(i)
 
-NETWORK.add_edges_from([
+NETWORK.add_edges_from_no_data([
     ( 0,  1), ( 0,  2), ( 0,  4), ( 0, 14), ( 0, 16), ( 0, 21),
     ( 1,  2), ( 1,  3), ( 1,  4), ( 1,  5), ( 1, 15), ( 1, 16),
     ( 2,  4), ( 2, 12), ( 2, 14), ( 2, 21), ( 3,  5), ( 3, 13),
@@ -140,51 +202,140 @@ NETWORK.add_edges_from([
     (19, 24), (20, 22), (20, 23), (22, 23), (22, 25), (23, 25)
 ])
 
-# Simulate a number of packet transitions
-for j in range(0, 100):
-    print("Iteration:", j)
-    for i in range(0, 26):
-        NETWORK.nodes[i]["device"].produce_msg()
+# The neighbors of every node as a bitmask, where bit j of ADJ_MASK[i] is set if
+# nodes i and j share an edge.
+ADJ_MASK = [0] * 26
+for (u, v) in NETWORK.edge_list():
+    ADJ_MASK[u] |= 1 << v
+    ADJ_MASK[v] |= 1 << u
 
-# Compute average number of packets given to forward, and the standard
-# deviations for each of the normal and black hole nodes.
-avg_normal_count  = 0
-avg_greedy_count  = 0
-sdev_normal_count = 0
-sdev_greedy_count = 0
+# The topology never changes, so compute the shortest path lengths between
+# every pair of nodes once, rather than on every hop.
+DISTANCE = rx.graph_distance_matrix(NETWORK).astype(int).tolist()
 
-for i in range(0, 26):
-    device = NETWORK.nodes[i]["device"]
-    if device.greed > 0.0:
-        avg_greedy_count += (device.count / 100)
-    else:
-        avg_normal_count += (device.count / 100)
+# Likewise, find every simple path between every pair of nodes that is at most
+# 3 hops longer than the shortest one, keyed by (src, dst).
+# The rustworkx cutoff counts nodes rather than edges, hence the 4.
+# For each pair, PATH_HOPS holds the next hop of every path as an int8 array,
+# and PATH_MASKS the bitmask of every path as a uint32 array, in the same order.
+# Shorter paths come first.
+PATH_HOPS = {}
+PATH_MASKS = {}
+for s in range(0, 26):
+    for d in range(0, 26):
+        if s != d:
+            cutoff = 4 + DISTANCE[s][d]
+            paths = rx.all_simple_paths(NETWORK, s, d, cutoff=cutoff)
+            paths = sorted(paths, key=lambda p: (len(p), p))
+            hops, masks = path_table(paths)
+            PATH_HOPS[(s, d)] = hops
+            PATH_MASKS[(s, d)] = masks
 
-avg_normal_count /= 21
-avg_greedy_count /= 5
+# Run every ping the device at index sends over the given number of
+# iterations, and return the statistics for just those pings, along with the
+# forward counts they caused. The baseline devices keep no state between
+# packets, so the pings of each device can be simulated apart from the others.
+# Each device of each run gets its own seed, so that results are repeatable.
+def simulate_device(index, iterations, seed, mode):
+    global FORWARD_MODE
+    global PINGS_SENT
+    global PINGS_RCVD
+    global PONGS_RCVD
+    global DROP_COUNT
+    
+    if mode not in FORWARD_MODES:
+        raise ValueError("unknown forward mode: %r" % mode)
+    FORWARD_MODE = mode
+    
+    # Worker processes are reused, so clear the statistics before each device.
+    PINGS_SENT = 0
+    PINGS_RCVD = 0
+    PONGS_RCVD = 0
+    DROP_COUNT = 0
+    COUNT[:] = 0
+    RNG.seed(seed * 26 + index)
+    
+    for _ in range(0, iterations):
+        produce_msg(index)
+    return PINGS_SENT, PINGS_RCVD, PONGS_RCVD, DROP_COUNT, COUNT.copy()
 
-for i in range(0, 26):
-    device = NETWORK.nodes[i]["device"]
-    if device.greed > 0.0:
-        square = ((device.count / 100) - avg_greedy_count) ** 2
-        sdev_greedy_count += square
+# Add up the statistics and forward counts of a number of simulations.
+def add_up(results):
+    sent, pings, pongs, drops = 0, 0, 0, 0
+    count = np.zeros(26, dtype=int)
+    for result in results:
+        sent  += result[0]
+        pings += result[1]
+        pongs += result[2]
+        drops += result[3]
+        count += result[4]
+    return sent, pings, pongs, drops, count
+
+# Run the whole simulation once, with the given seed and forward mode, and
+# return its statistics.
+def run(seed, mode="random"):
+    results = (simulate_device(i, ITERATIONS, seed, mode) for i in range(0, 26))
+    return add_up(results)
+
+if __name__ == "__main__":
+    # The number of independent runs to average over may be given, default 1,
+    # followed by the forward mode, default "random".
+    runs = sys.argv[1] if len(sys.argv) > 1 else "1"
+    mode = sys.argv[2] if len(sys.argv) > 2 else "random"
+    if (len(sys.argv) > 3 or not runs.isdigit() or int(runs) < 1
+            or mode not in FORWARD_MODES):
+        sys.exit("usage: %s [runs] [%s], where runs is a positive integer"
+                 % (sys.argv[0], "|".join(FORWARD_MODES)))
+    runs = int(runs)
+    
+    # Simulate a number of packet transitions. Each run only depends on its
+    # seed, so several runs each get a core of their own.
+    if runs == 1:
+        totals = run(0, mode)
     else:
-        square = ((device.count / 100) - avg_normal_count) ** 2
-        sdev_normal_count += square
-
-sdev_normal_count = (sdev_normal_count / 21) ** 0.5
-sdev_greedy_count = (sdev_greedy_count / 5)  ** 0.5
-
-# Output statistics
-packets_sent        = PINGS_SENT + PINGS_RCVD
-ping_reliability    = (PINGS_RCVD / PINGS_SENT) * 100
-pong_reliability    = (PONGS_RCVD / PINGS_RCVD) * 100
-overall_reliability = (1 - (DROP_COUNT / packets_sent)) * 100
-
-print("Ping Reliability:    %.3f%%" % ping_reliability)
-print("Pong Reliability:    %.3f%%" % pong_reliability)
-print("Overall Reliability: %.3f%%" % overall_reliability)
-print("Avg. Normal Fwd:     %3.3f"  % avg_normal_count)
-print("Avg. Greedy Fwd:     %3.3f"  % avg_greedy_count)
-print("St. Dev. Normal Fwd: %3.3f"  % sdev_normal_count)
-print("St. Dev. Greedy Fwd: %3.3f"  % sdev_greedy_count)
+        with ProcessPoolExecutor(max_workers=cpu_count()) as executor:
+            totals = add_up(executor.map(run, range(0, runs), [mode] * runs))
+    
+    PINGS_SENT, PINGS_RCVD, PONGS_RCVD, DROP_COUNT, COUNT = totals
+    iterations = ITERATIONS * runs
+    
+    # Compute average number of packets given to forward, and the standard
+    # deviations for each of the normal and black hole nodes.
+    avg_normal_count  = 0
+    avg_greedy_count  = 0
+    sdev_normal_count = 0
+    sdev_greedy_count = 0
+
+    for i in range(0, 26):
+        if GREED[i] > 0.0:
+            avg_greedy_count += (COUNT[i] / iterations)
+        else:
+            avg_normal_count += (COUNT[i] / iterations)
+
+    avg_normal_count /= 21
+    avg_greedy_count /= 5
+
+    for i in range(0, 26):
+        if GREED[i] > 0.0:
+            square = ((COUNT[i] / iterations) - avg_greedy_count) ** 2
+            sdev_greedy_count += square
+        else:
+            square = ((COUNT[i] / iterations) - avg_normal_count) ** 2
+            sdev_normal_count += square
+
+    sdev_normal_count = (sdev_normal_count / 21) ** 0.5
+    sdev_greedy_count = (sdev_greedy_count / 5)  ** 0.5
+
+    # Output statistics
+    packets_sent        = PINGS_SENT + PINGS_RCVD
+    ping_reliability    = (PINGS_RCVD / PINGS_SENT) * 100
+    pong_reliability    = (PONGS_RCVD / PINGS_RCVD) * 100
+    overall_reliability = (1 - (DROP_COUNT / packets_sent)) * 100
+
+    print("Ping Reliability:    %.3f%%" % ping_reliability)
+    print("Pong Reliability:    %.3f%%" % pong_reliability)
+    print("Overall Reliability: %.3f%%" % overall_reliability)
+    print("Avg. Normal Fwd:     %3.3f"  % avg_normal_count)
+    print("Avg. Greedy Fwd:     %3.3f"  % avg_greedy_count)
+    print("St. Dev. Normal Fwd: %3.3f"  % sdev_normal_count)
+    print("St. Dev. Greedy Fwd: %3.3f"  % sdev_greedy_count)
@@ -0,0 +1,49 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# Description: Compiled path selection for the Baseline MANET simulator.
+# Picking a path is the inner loop of the baseline, so it is worth compiling.
+# Build it in place, next to the simulator, with:
+#   CFLAGS="-O3 -march=native" cythonize -i routing.pyx
+# If it has not been built, the simulator falls back to a Python version.
+
+# Randomly select a path from one (src, dst) pair's path table that does not
+# pass through any index in hist_mask, and return its next hop, or -1 if there
+# are none. r is a uniform random number in [0, 1) that decides which of the
+# clear paths is chosen, so every one of them is equally likely.
+# The table is given as the path_masks and path_hops arrays from the simulator.
+cpdef int next_hop(unsigned int hist_mask, const unsigned int[::1] path_masks,
+                   const signed char[::1] path_hops, double r):
+    cdef Py_ssize_t n = path_masks.shape[0]
+    cdef Py_ssize_t count = 0
+    cdef Py_ssize_t found = -1
+    cdef Py_ssize_t i, pick
+
+    with nogil:
+        # Count the clear paths. There are no branches in this loop, so the
+        # compiler is free to vectorize it.
+        for i in range(n):
+            count += (path_masks[i] & hist_mask) == 0
+
+        # Then walk over them again to find the one r picked.
+        pick = <Py_ssize_t>(r * count)
+        for i in range(n):
+            if (path_masks[i] & hist_mask) == 0:
+                if pick == 0:
+                    found = i
+                    break
+                pick -= 1
+
+    if found < 0:
+        return -1
+    return path_hops[found]
+
+# Return the next hop of the first path in the table that does not pass through
+# any index in hist_mask, or -1 if there are none. As the simulator sorts its
+# tables by length, this is the shortest clear path.
+cpdef int first_clear_hop(unsigned int hist_mask,
+                          const unsigned int[::1] path_masks,
+                          const signed char[::1] path_hops):
+    cdef Py_ssize_t i
+    for i in range(path_masks.shape[0]):
+        if (path_masks[i] & hist_mask) == 0:
+            return path_hops[i]
+    return -1
@@ -4,14 +4,30 @@
 # This is the Trusty MANET which forwards data based on a trustworthiness score
 # assigned to each node's neighbors.
 
-from numpy import sum, exp
-from numpy.random import choice
-import networkx as nx
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+import numpy as np
+import rustworkx as rx
 import random
+import sys
+
+# Numba compiles the path search below to machine code. Without it, the search
+# still works, it just runs as ordinary (much slower) Python.
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 # A global object for storing all network adjacencies and paths.
 # We assume that every device knows the full network topology, for simplicity.
-NETWORK = nx.Graph()
+NETWORK = rx.PyGraph()
+
+# The number of times every device sends a ping in a run of the simulation.
+ITERATIONS = 100
+
+# The one source of randomness in the simulation, reseeded for every run.
+RNG = random.Random()
 
 # Statistics for reliability
 PINGS_SENT = 0
@@ -22,147 +38,203 @@ DROP_COUNT = 0
 # Softmax function: maps an array of values (trust scores) to an array of
 # weights, all between 0 and 1, which sum to 1. We use this to determine which
 # neighbor to forward to based on their trust scores.
+# Subtracting the maximum first keeps exp from overflowing on large scores.
 def softmax(ary):
-    logits = exp(ary) / sum(exp(ary))
-    return list(logits)
+    e = np.exp(ary - ary.max())
+    return e / e.sum()
+
+# Find the neighbors of src that begin a simple path to dst of at most cutoff
+# hops which avoids every index in history_mask. We only ever need the next hop
+# of such a path, so rather than enumerating the paths themselves, search
+# outwards from dst for everything within cutoff - 1 hops of it, without passing
+# through src or the history. A shortest route like this never revisits a node.
+# The graph is given as the INDPTR and INDICES arrays, so this can be compiled.
+@njit(cache=True)
+def viable_next_hops(src, dst, history_mask, cutoff, indptr, indices):
+    blocked = history_mask | (1 << src)
+    reached = 1 << dst
+    
+    # The neighbors of src that the search could reach. Once it has found all
+    # of them, there is no point searching any further.
+    wanted = 0
+    for k in range(indptr[src], indptr[src + 1]):
+        wanted |= 1 << indices[k]
+    wanted &= ~blocked
+    
+    # Breadth-first search, where queue[start:end] is the current depth.
+    queue = np.empty(len(indptr) - 1, dtype=np.int32)
+    queue[0] = dst
+    start = 0
+    end = 1
+    for _ in range(1, cutoff):
+        if (reached & wanted) == wanted or start == end:
+            break
+        depth_end = end
+        for i in range(start, depth_end):
+            index = queue[i]
+            for k in range(indptr[index], indptr[index + 1]):
+                neighbor = indices[k]
+                bit = 1 << neighbor
+                if not (reached | blocked) & bit:
+                    reached |= bit
+                    queue[end] = neighbor
+                    end += 1
+        start = depth_end
+    
+    # Keep the neighbors of src that the search reached.
+    hops = np.empty(indptr[src + 1] - indptr[src], dtype=np.int32)
+    count = 0
+    for k in range(indptr[src], indptr[src + 1]):
+        if reached >> indices[k] & 1:
+            hops[count] = indices[k]
+            count += 1
+    return hops[:count]
 
 # A simple message with a sender, intended receiver, data, and a history of the
 # indices of recipients who have forwarded on this message. The src and dst
 # fields are the indices of the original sender and intended recipient.
+# The history is a bitmask, where bit i is set if device i has forwarded it.
 class Message:
     def __init__(self, src, dst, content):
         self.src = src
         self.dst = dst
         self.content = content
-        self.history = []
+        self.history_mask = 0
+        self.last_hop = None
     
     # Mark a message as having been sent by a device.
     def postmark(self, index):
-        self.history.append(index)
-    
-    # Report if any of the elements in a path are in the message's history.
-    def has_cycles_in(self, path):
-        for index in path:
-            if index in self.history:
-                return True
-        return False
+        self.history_mask |= 1 << index
+        self.last_hop = index
 
 # Every node in the network has an index and an associated device.
 # The index is how the device is found in the global NETWORK object.
-# The device is an actor that creates, receives, and acts upon messages.
+# The device is an actor that creates, receives, and acts upon messages, and
+# the state of every device is kept in the arrays below, indexed the same way.
 # Every device has a set level of "greed", indicating how likely it is to behave
 # selfishly. A value of 0 means never, 1 means always, in between is random.
 # Devices also have a "trust" score for every other device. This reflects the
 # number of packets successfully forwarded through a given node.
 # Count is the number of packets the device has been given to forward.
-class Device:    
-    def __init__(self, index, greed):
-        self.index = index
-        self.greed = greed
-        self.trust = [0 for _ in range(0, 26)]
-        self.count = 0
-        self.got_pong = False
-    
-    # Uses a trust system to decide the next hop from a list of paths.
-    def trusty_next_hop(self, paths):
-        # Get a unique list of all next hops from the list of paths.
-        hops = [p[1] for p in paths]
-        uniq = list(set(hops))
-        
-        # Compute a probability for each hop based on its trustworthiness score.
-        scores = [self.trust[t] for t in uniq]
-        logits = softmax(scores)
-        
-        # Make a random choice weighted by those probabilities
-        return choice(uniq, 1, p=logits)[0]
-    
-    # Forwards a message to the best receiver possible.
-    # In other implementations, this is where we would place our "trust" system.
-    # In all implementations, we are assuming we have already made the decision
-    # to forward the packet. Nodes that are selfish won't call this method.
-    # Returns the next hop in the message's path, or None if dropped.
-    def forward_msg(self, msg):
-        # Always forward to the intended recipient if possible.
-        if NETWORK.has_edge(self.index, msg.dst):
-            msg.postmark(self.index)
-            NETWORK.nodes[msg.dst]["device"].receive_msg(msg)
-            return msg.dst
-        
-        # Find a path that does not return to a previously visited node.
-        spl = nx.shortest_path_length(NETWORK, self.index, msg.dst)
-        paths = nx.all_simple_paths(NETWORK, self.index, msg.dst, cutoff=3+spl)
-        options = [p for p in list(paths) if not msg.has_cycles_in(p)]
-        
-        # If none exist, drop the packet. This should not happen.
-        if len(options) == 0:
-            return None
-        
-        # Otherwise, choose a path based on our trust system
-        next_hop = self.trusty_next_hop(options)
-        
-        # Send the message on its merry way.
-        msg.postmark(self.index)
-        NETWORK.nodes[next_hop]["device"].receive_msg(msg)
-        return next_hop
-    
-    # Called by other devices sending this device a message.
-    # Here we decide whether to forward or drop a packet, or to do something
-    # with it, as we are the intended recipient.
-    def receive_msg(self, msg):
-        global PINGS_SENT
-        global PINGS_RCVD
-        global PONGS_RCVD
-        global DROP_COUNT
-        
-        if self.index == msg.dst:
-            last_hop = msg.history[-1]
-            if last_hop != msg.src:
-                self.trust[last_hop] += 1
-
-            if msg.content == "ping":
-                PINGS_RCVD += 1
-                response = Message(self.index, msg.src, "pong")
-                self.forward_msg(response)
-            elif msg.content == "pong":
-                PONGS_RCVD += 1
-                self.got_pong = True
-        elif random.random() >= self.greed:
-            self.count += 1
-            self.forward_msg(msg)
+# Got pong records whether the device's latest ping has been answered.
+GREED = np.zeros(26)
+TRUST = np.zeros((26, 26), dtype=np.float32)
+COUNT = np.zeros(26, dtype=int)
+GOT_PONG = np.zeros(26, dtype=bool)
+
+# Uses a trust system to decide the next hop from a list of unique hops.
+def trusty_next_hop(index, uniq):
+    # Compute a probability for each hop based on its trustworthiness score.
+    scores = TRUST[index, np.asarray(uniq, dtype=np.intp)]
+    logits = softmax(scores)
+    
+    # Make a random choice weighted by those probabilities
+    return int(RNG.choices(uniq, weights=logits)[0])
+
+# Chooses the best receiver for the device at index to forward a message to.
+# In other implementations, this is where we would place our "trust" system.
+# In all implementations, we are assuming we have already made the decision
+# to forward the packet. Nodes that are selfish won't call this method.
+# Returns the next hop in the message's path, or None if dropped.
+def forward_msg(index, msg):
+    # Always forward to the intended recipient if possible.
+    if ADJ_MASK[index] >> msg.dst & 1:
+        msg.postmark(index)
+        return msg.dst
+    
+    # Find the next hops of paths that do not return to a previously
+    # visited node, and are at most 3 hops longer than the shortest path.
+    hist = msg.history_mask
+    cutoff = 3 + DISTANCE[index][msg.dst]
+    options = viable_next_hops(index, msg.dst, hist, cutoff, INDPTR, INDICES)
+    
+    # If none exist, drop the packet. This should not happen.
+    if len(options) == 0:
+        return None
+    
+    # Otherwise, choose a next hop based on our trust system. Every viable hop
+    # is offered to it: keeping only those on the few shortest paths would
+    # steer it toward short routes and change the reliability being measured.
+    next_hop = trusty_next_hop(index, options)
+    
+    # Send the message on its merry way.
+    msg.postmark(index)
+    return next_hop
+
+# Called when other devices send the device at index a message.
+# Here we decide whether to forward or drop a packet, or to do something
+# with it, as we are the intended recipient.
+# Returns the message to forward on next, either this one or our reply to
+# it, or None if there is nothing more to send.
+def receive_msg(index, msg):
+    global PINGS_SENT
+    global PINGS_RCVD
+    global PONGS_RCVD
+    global DROP_COUNT
+    
+    if index == msg.dst:
+        last_hop = msg.last_hop
+        if last_hop != msg.src:
+            TRUST[index, last_hop] += 1
+
+        if msg.content == "ping":
+            PINGS_RCVD += 1
+            return Message(index, msg.src, "pong")
+        elif msg.content == "pong":
+            PONGS_RCVD += 1
+            GOT_PONG[index] = True
+    elif RNG.random() >= GREED[index]:
+        COUNT[index] += 1
+        return msg
+    else:
+        COUNT[index] += 1
+        DROP_COUNT += 1
+    return None
+
+# Have the device at index create a message to a random destination, and send
+# it off.
+def produce_msg(index):
+    global PINGS_SENT
+    
+    # Select a random destination other than ourselves, by picking from
+    # the 25 other indices and skipping over our own.
+    dst = RNG.randrange(25)
+    if dst >= index:
+        dst += 1
+    src = index
+    
+    # Create a message and send it off into the ethers.
+    PINGS_SENT += 1
+    msg = Message(src, dst, "ping")
+    hop = forward_msg(index, msg)
+    deliver(hop, msg)
+    
+    # Increase trust if we received a pong, else decrease it.
+    # Don't do this for immediate neighbors, however. They'll always pong.
+    if hop != dst:
+        if GOT_PONG[index]:
+            TRUST[index, hop] += 1
         else:
-            self.count += 1
-            DROP_COUNT += 1
-    
-    # Create a new message to a random destination, and send it off.
-    def produce_msg(self):
-        global PINGS_SENT
-        
-        # Select a random destination other than ourselves.
-        destinations = [i for i in NETWORK.nodes if i != self.index]
-        dst = random.choice(destinations)
-        src = self.index
-        
-        # Create a message and send it off into the ethers.
-        PINGS_SENT += 1
-        msg = Message(src, dst, "ping")
-        hop = self.forward_msg(msg)
-        
-        # Increase trust if we received a pong, else decrease it.
-        # Don't do this for immediate neighbors, however. They'll always pong.
-        if hop != dst:
-            if self.got_pong:
-                self.trust[hop] += 1
-            else:
-                self.trust[hop] -= 1
-        self.got_pong = False
+            TRUST[index, hop] -= 1
+    GOT_PONG[index] = False
+
+# Carry a message the rest of the way once it has been forwarded to hop.
+# Each device along the way receives it, then forwards it or its reply on in
+# turn, until there is nothing more to send or nowhere to send it.
+def deliver(hop, msg):
+    while hop is not None:
+        msg = receive_msg(hop, msg)
+        if msg is None:
+            return
+        hop = forward_msg(hop, msg)
 
 # Setup network connections
 black_holes = [1,2,8,11,22]
 for i in range(0, 26):
-    greed = float(i in black_holes)
-    NETWORK.add_node(i, device=Device(i, greed))
+    GREED[i] = float(i in black_holes)
+    NETWORK.add_node(i)
 
-NETWORK.add_edges_from([
+NETWORK.add_edges_from_no_data([
     ( 0,  1), ( 0,  2), ( 0,  4), ( 0, 14), ( 0, 16), ( 0, 21),
     ( 1,  2), ( 1,  3), ( 1,  4), ( 1,  5), ( 1, 15), ( 1, 16),
     ( 2,  4), ( 2, 12), ( 2, 14), ( 2, 21), ( 3,  5), ( 3, 13),
@@ -175,51 +247,118 @@ NETWORK.add_edges_from([
     (19, 24), (20, 22), (20, 23), (22, 23), (22, 25), (23, 25)
 ])
 
-# Simulate a number of packet transitions
-for j in range(0, 100):
-    print("Iteration:", j)
-    for i in range(0, 26):
-        NETWORK.nodes[i]["device"].produce_msg()
+# The neighbors of every node as a bitmask, where bit j of ADJ_MASK[i] is set if
+# nodes i and j share an edge.
+ADJ_MASK = [0] * 26
+for (u, v) in NETWORK.edge_list():
+    ADJ_MASK[u] |= 1 << v
+    ADJ_MASK[v] |= 1 << u
 
-# Compute average number of packets given to forward, and the standard
-# deviations for each of the normal and black hole nodes.
-avg_normal_count  = 0
-avg_greedy_count  = 0
-sdev_normal_count = 0
-sdev_greedy_count = 0
+# The topology never changes, so compute the shortest path lengths between
+# every pair of nodes once, rather than on every hop.
+DISTANCE = rx.graph_distance_matrix(NETWORK).astype(int).tolist()
 
+# The adjacency lists of NETWORK in compressed sparse row form, where the
+# neighbors of node i are INDICES[INDPTR[i]:INDPTR[i + 1]].
+INDPTR = np.zeros(27, dtype=np.int32)
+INDICES = np.zeros(2 * NETWORK.num_edges(), dtype=np.int32)
 for i in range(0, 26):
-    device = NETWORK.nodes[i]["device"]
-    if device.greed > 0.0:
-        avg_greedy_count += (device.count / 100)
-    else:
-        avg_normal_count += (device.count / 100)
+    neighbors = sorted(NETWORK.neighbors(i))
+    INDPTR[i + 1] = INDPTR[i] + len(neighbors)
+    INDICES[INDPTR[i]:INDPTR[i + 1]] = neighbors
 
-avg_normal_count /= 21
-avg_greedy_count /= 5
+# Run the whole simulation once, with the given seed, and return its statistics
+# along with the number of packets each device was given to forward.
+# Every run starts over with fresh trust scores, as worker processes are reused.
+def run(seed, verbose=False):
+    global PINGS_SENT
+    global PINGS_RCVD
+    global PONGS_RCVD
+    global DROP_COUNT
+    
+    PINGS_SENT = 0
+    PINGS_RCVD = 0
+    PONGS_RCVD = 0
+    DROP_COUNT = 0
+    TRUST[:] = 0
+    COUNT[:] = 0
+    GOT_PONG[:] = False
+    RNG.seed(seed)
+    
+    # Simulate a number of packet transitions, reporting progress now and then.
+    for j in range(0, ITERATIONS):
+        if verbose and j % 10 == 0:
+            print("Iteration:", j)
+        for i in range(0, 26):
+            produce_msg(i)
+    return PINGS_SENT, PINGS_RCVD, PONGS_RCVD, DROP_COUNT, COUNT.copy()
 
-for i in range(0, 26):
-    device = NETWORK.nodes[i]["device"]
-    if device.greed > 0.0:
-        square = ((device.count / 100) - avg_greedy_count) ** 2
-        sdev_greedy_count += square
+# Add up the statistics and forward counts of a number of simulations.
+def add_up(results):
+    sent, pings, pongs, drops = 0, 0, 0, 0
+    count = np.zeros(26, dtype=int)
+    for result in results:
+        sent  += result[0]
+        pings += result[1]
+        pongs += result[2]
+        drops += result[3]
+        count += result[4]
+    return sent, pings, pongs, drops, count
+
+if __name__ == "__main__":
+    # The number of independent runs to average over may be given, default 1.
+    # Each run only depends on its seed, so they each get a core of their own.
+    runs = sys.argv[1] if len(sys.argv) > 1 else "1"
+    if not runs.isdigit() or int(runs) < 1:
+        sys.exit("usage: %s [runs], where runs is a positive integer"
+                 % sys.argv[0])
+    runs = int(runs)
+    if runs == 1:
+        totals = run(0, verbose=True)
     else:
-        square = ((device.count / 100) - avg_normal_count) ** 2
-        sdev_normal_count += square
-
-sdev_normal_count = (sdev_normal_count / 21) ** 0.5
-sdev_greedy_count = (sdev_greedy_count / 5)  ** 0.5
-
-# Output statistics
-packets_sent        = PINGS_SENT + PINGS_RCVD
-ping_reliability    = (PINGS_RCVD / PINGS_SENT) * 100
-pong_reliability    = (PONGS_RCVD / PINGS_RCVD) * 100
-overall_reliability = (1 - (DROP_COUNT / packets_sent)) * 100
-
-print("Ping Reliability:    %.3f%%" % ping_reliability)
-print("Pong Reliability:    %.3f%%" % pong_reliability)
-print("Overall Reliability: %.3f%%" % overall_reliability)
-print("Avg. Normal Fwd:     %3.3f"  % avg_normal_count)
-print("Avg. Greedy Fwd:     %3.3f"  % avg_greedy_count)
-print("St. Dev. Normal Fwd: %3.3f"  % sdev_normal_count)
-print("St. Dev. Greedy Fwd: %3.3f"  % sdev_greedy_count)
+        with ProcessPoolExecutor(max_workers=cpu_count()) as executor:
+            totals = add_up(executor.map(run, range(0, runs)))
+    
+    PINGS_SENT, PINGS_RCVD, PONGS_RCVD, DROP_COUNT, COUNT = totals
+    iterations = ITERATIONS * runs
+    
+    # Compute average number of packets given to forward, and the standard
+    # deviations for each of the normal and black hole nodes.
+    avg_normal_count  = 0
+    avg_greedy_count  = 0
+    sdev_normal_count = 0
+    sdev_greedy_count = 0
+
+    for i in range(0, 26):
+        if GREED[i] > 0.0:
+            avg_greedy_count += (COUNT[i] / iterations)
+        else:
+            avg_normal_count += (COUNT[i] / iterations)
+
+    avg_normal_count /= 21
+    avg_greedy_count /= 5
+
+    for i in range(0, 26):
+        if GREED[i] > 0.0:
+            square = ((COUNT[i] / iterations) - avg_greedy_count) ** 2
+            sdev_greedy_count += square
+        else:
+            square = ((COUNT[i] / iterations) - avg_normal_count) ** 2
+            sdev_normal_count += square
+
+    sdev_normal_count = (sdev_normal_count / 21) ** 0.5
+    sdev_greedy_count = (sdev_greedy_count / 5)  ** 0.5
+
+    # Output statistics
+    packets_sent        = PINGS_SENT + PINGS_RCVD
+    ping_reliability    = (PINGS_RCVD / PINGS_SENT) * 100
+    pong_reliability    = (PONGS_RCVD / PINGS_RCVD) * 100
+    overall_reliability = (1 - (DROP_COUNT / packets_sent)) * 100
+
+    print("Ping Reliability:    %.3f%%" % ping_reliability)
+    print("Pong Reliability:    %.3f%%" % pong_reliability)
+    print("Overall Reliability: %.3f%%" % overall_reliability)
+    print("Avg. Normal Fwd:     %3.3f"  % avg_normal_count)
+    print("Avg. Greedy Fwd:     %3.3f"  % avg_greedy_count)
+    print("St. Dev. Normal Fwd: %3.3f"  % sdev_normal_count)
+    print("St. Dev. Greedy Fwd: %3.3f"  % sdev_greedy_count)